@@ -1,13 +1,19 @@
 from mcp.server.fastmcp import FastMCP, Context
 import httpx
-from bs4 import BeautifulSoup
-from typing import List, Dict, Optional, Any
+from selectolax.lexbor import LexborHTMLParser
+from typing import List, Dict, Optional, Any, Tuple
+from collections import OrderedDict
 from dataclasses import dataclass
 import urllib.parse
+import html
+import codecs
 import sys
 import traceback
 import asyncio
-from datetime import datetime, timedelta
+import anyio
+import uvicorn
+from contextlib import asynccontextmanager
+import itertools
 import time
 import re
 import argparse
@@ -17,6 +23,33 @@ import logging
 import json
 
 
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+}
+
+DDG_REDIRECT_PREFIX = "//duckduckgo.com/l/?uddg="
+
+# Captures (href, title, snippet) of each result on html.duckduckgo.com. The
+# snippet is optional and must appear before the next result's title link.
+DDG_RESULT_RE = re.compile(
+    r'<a\s[^>]*class="result__a"[^>]*href="([^"]*)"[^>]*>(.*?)</a>'
+    r'(?:(?:(?!class="result__a").)*?'
+    r'<(?:a|div)\s[^>]*class="result__snippet"[^>]*>(.*?)</(?:a|div)>)?',
+    re.S,
+)
+
+# Matches both <meta charset="..."> and <meta http-equiv="Content-Type" content="...; charset=...">
+META_CHARSET_RE = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?([\w.:-]+)""", re.I)
+
+# Shared client so connections (and HTTP/2 streams) are reused across tool calls
+_HTTP_CLIENT = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    timeout=30.0,
+    headers=DEFAULT_HEADERS,
+)
+
+
 @dataclass
 class SearchResult:
     title: str
@@ -26,34 +59,70 @@ class SearchResult:
 
 
 class RateLimiter:
+    """Token bucket allowing bursts of up to `requests_per_minute` requests"""
+
     def __init__(self, requests_per_minute: int = 30):
         self.requests_per_minute = requests_per_minute
-        self.requests = []
+        self.capacity = float(requests_per_minute)
+        self.rate = requests_per_minute / 60.0  # tokens per second
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self._lock = asyncio.Lock()
 
     async def acquire(self):
-        now = datetime.now()
-        # Remove requests older than 1 minute
-        self.requests = [
-            req for req in self.requests if now - req < timedelta(minutes=1)
-        ]
+        async with self._lock:
+            now = time.monotonic()
+            # Refill tokens for the time elapsed since the last call
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.last_refill) * self.rate
+            )
+            self.last_refill = now
 
-        if len(self.requests) >= self.requests_per_minute:
-            # Wait until we can make another request
-            wait_time = 60 - (now - self.requests[0]).total_seconds()
-            if wait_time > 0:
-                await asyncio.sleep(wait_time)
+            if self.tokens < 1:
+                # Wait until a full token has accumulated
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self.last_refill = time.monotonic()
+                self.tokens = 1
 
-        self.requests.append(now)
+            self.tokens -= 1
+
+
+class ContentCache:
+    """LRU cache whose entries expire `ttl` seconds after being stored"""
+
+    def __init__(self, maxsize: int = 256, ttl: float = 600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[str, Tuple[float, str]] = OrderedDict()
+        self._lock = asyncio.Lock()
+
+    async def get(self, key: str) -> Optional[str]:
+        async with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    async def set(self, key: str, value: str):
+        async with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            # Evict the least recently used entries
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
 
 
 class DuckDuckGoSearcher:
     BASE_URL = "https://html.duckduckgo.com/html"
-    HEADERS = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-    }
-
-    def __init__(self):
-        self.rate_limiter = RateLimiter()
+    # Shared by all instances so concurrent searchers draw from one DuckDuckGo budget
+    rate_limiter = RateLimiter()
 
     def format_results_for_llm(self, results: List[SearchResult]) -> str:
         """Format results in a natural language style that's easier for LLMs to process"""
@@ -64,13 +133,77 @@ class DuckDuckGoSearcher:
         output.append(f"Found {len(results)} search results:\n")
 
         for result in results:
-            output.append(f"{result.position}. {result.title}")
-            output.append(f"   URL: {result.link}")
-            output.append(f"   Summary: {result.snippet}")
-            output.append("")  # Empty line between results
+            # One entry per result; the trailing newline leaves an empty line between results
+            output.append(
+                f"{result.position}. {result.title}\n"
+                f"   URL: {result.link}\n"
+                f"   Summary: {result.snippet}\n"
+            )
 
         return "\n".join(output)
 
+    def _append_result(
+        self, results: List[SearchResult], title: str, link: str, snippet: str
+    ):
+        # Skip ad results
+        if "y.js" in link:
+            return
+
+        # Clean up DuckDuckGo redirect URLs
+        if link.startswith(DDG_REDIRECT_PREFIX):
+            target = link[len(DDG_REDIRECT_PREFIX):]
+            amp = target.find("&")
+            link = urllib.parse.unquote(target if amp < 0 else target[:amp])
+
+        results.append(
+            SearchResult(
+                title=title,
+                link=link,
+                snippet=snippet,
+                position=len(results) + 1,
+            )
+        )
+
+    def _parse_results_regex(self, text: str, max_results: int) -> List[SearchResult]:
+        """Extract results with a regex over the raw HTML, without building a DOM"""
+        results = []
+        for match in DDG_RESULT_RE.finditer(text):
+            href, title_html, snippet_html = match.groups()
+            self._append_result(
+                results,
+                title=LexborHTMLParser(title_html).text(strip=True),
+                link=html.unescape(href),
+                snippet=LexborHTMLParser(snippet_html).text(strip=True) if snippet_html else "",
+            )
+
+            if len(results) >= max_results:
+                break
+
+        return results
+
+    def _parse_results_dom(
+        self, tree: LexborHTMLParser, max_results: int
+    ) -> List[SearchResult]:
+        """Extract results from the parsed DOM of the results page"""
+        results = []
+        for result in tree.css(".result"):
+            link_elem = result.css_first(".result__title a")
+            if not link_elem:
+                continue
+
+            snippet_elem = result.css_first(".result__snippet")
+            self._append_result(
+                results,
+                title=link_elem.text(strip=True),
+                link=link_elem.attributes.get("href") or "",
+                snippet=snippet_elem.text(strip=True) if snippet_elem else "",
+            )
+
+            if len(results) >= max_results:
+                break
+
+        return results
+
     async def search(
         self, query: str, ctx: Context, max_results: int = 10
     ) -> List[SearchResult]:
@@ -87,53 +220,18 @@ class DuckDuckGoSearcher:
 
             await ctx.info(f"Searching DuckDuckGo for: {query}")
 
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    self.BASE_URL, data=data, headers=self.HEADERS, timeout=30.0
-                )
-                response.raise_for_status()
+            response = await _HTTP_CLIENT.post(self.BASE_URL, data=data)
+            response.raise_for_status()
 
-            # Parse HTML response
-            soup = BeautifulSoup(response.text, "html.parser")
-            if not soup:
-                await ctx.error("Failed to parse HTML response")
-                return []
-
-            results = []
-            for result in soup.select(".result"):
-                title_elem = result.select_one(".result__title")
-                if not title_elem:
-                    continue
-
-                link_elem = title_elem.find("a")
-                if not link_elem:
-                    continue
-
-                title = link_elem.get_text(strip=True)
-                link = link_elem.get("href", "")
-
-                # Skip ad results
-                if "y.js" in link:
-                    continue
-
-                # Clean up DuckDuckGo redirect URLs
-                if link.startswith("//duckduckgo.com/l/?uddg="):
-                    link = urllib.parse.unquote(link.split("uddg=")[1].split("&")[0])
-
-                snippet_elem = result.select_one(".result__snippet")
-                snippet = snippet_elem.get_text(strip=True) if snippet_elem else ""
-
-                results.append(
-                    SearchResult(
-                        title=title,
-                        link=link,
-                        snippet=snippet,
-                        position=len(results) + 1,
-                    )
-                )
-
-                if len(results) >= max_results:
-                    break
+            # Extract results straight from the markup, falling back to a full
+            # DOM parse if nothing matched (e.g. DuckDuckGo changed its markup)
+            results = self._parse_results_regex(response.text, max_results)
+            if not results:
+                tree = LexborHTMLParser(response.text)
+                if tree.body is None:
+                    await ctx.error("Failed to parse HTML response")
+                    return []
+                results = self._parse_results_dom(tree, max_results)
 
             await ctx.info(f"Successfully found {len(results)} results")
             return results
@@ -151,48 +249,96 @@ class DuckDuckGoSearcher:
 
 
 class WebContentFetcher:
+    MAX_HTML_BYTES = 512_000
+    MAX_TEXT_CHARS = 8000
+    # How far into the page to look for a <meta> charset declaration
+    CHARSET_SNIFF_BYTES = 4096
+    # Tags whose content is dropped before extracting the page text
+    STRIP_TAGS = ("script", "style", "nav", "header", "footer")
+    STRIP_SELECTOR = ",".join(STRIP_TAGS)
+
     def __init__(self):
         self.rate_limiter = RateLimiter(requests_per_minute=20)
+        self.cache = ContentCache(maxsize=256, ttl=600.0)
+
+    def _detect_encoding(self, header_charset: Optional[str], body: bytes) -> str:
+        """Pick the page encoding from the header charset, then <meta> tags, then UTF-8"""
+        candidates = [header_charset]
+        match = META_CHARSET_RE.search(body, 0, self.CHARSET_SNIFF_BYTES)
+        if match:
+            candidates.append(match.group(1).decode("ascii"))
+
+        for candidate in candidates:
+            if not candidate:
+                continue
+            try:
+                return codecs.lookup(candidate).name
+            except LookupError:
+                continue
+
+        return "utf-8"
 
     async def fetch_and_parse(self, url: str, ctx: Context) -> str:
         """Fetch and parse content from a webpage"""
         try:
+            cached = await self.cache.get(url)
+            if cached is not None:
+                await ctx.info(f"Using cached content for: {url} ({len(cached)} characters)")
+                return cached
+
             await self.rate_limiter.acquire()
 
             await ctx.info(f"Fetching content from: {url}")
 
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    url,
-                    headers={
-                        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
-                    },
-                    follow_redirects=True,
-                    timeout=30.0,
-                )
+            # Stream the body so oversized pages are never fully buffered
+            async with _HTTP_CLIENT.stream(
+                "GET",
+                url,
+                headers={
+                    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
+                },
+                follow_redirects=True,
+            ) as response:
                 response.raise_for_status()
 
+                # Reject binaries (PDFs, images, ...) before downloading the body.
+                # Pages without a declared type are still parsed as HTML.
+                content_type_header = response.headers.get("content-type")
+                content_type = (content_type_header or "").strip().lower()
+                if not content_type:
+                    if content_type_header is None:
+                        await ctx.info(f"No content-type header from {url}, parsing as HTML")
+                    else:
+                        await ctx.info(f"Empty content-type header from {url}, parsing as HTML")
+                elif "html" not in content_type and "xml" not in content_type:
+                    await ctx.error(f"Skipping unsupported content from {url}: {content_type}")
+                    return f"Error: unsupported content-type {content_type}"
+
+                # Only the head of the page is parsed since the text is truncated anyway
+                buffer = bytearray()
+                async for chunk in response.aiter_bytes():
+                    buffer += chunk
+                    if len(buffer) >= self.MAX_HTML_BYTES:
+                        break
+                encoding = self._detect_encoding(response.charset_encoding, buffer)
+
             # Parse the HTML
-            soup = BeautifulSoup(response.text, "html.parser")
+            page = bytes(buffer[: self.MAX_HTML_BYTES]).decode(encoding, errors="replace")
+            tree = LexborHTMLParser(page)
 
-            # Remove script and style elements
-            for element in soup(["script", "style", "nav", "header", "footer"]):
+            # Remove script and style elements in a single CSS pass
+            for element in tree.css(self.STRIP_SELECTOR):
                 element.decompose()
 
-            # Get the text content
-            text = soup.get_text()
-
-            # Clean up the text
-            lines = (line.strip() for line in text.splitlines())
-            chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-            text = " ".join(chunk for chunk in chunks if chunk)
-
-            # Remove extra whitespace
-            text = re.sub(r"\s+", " ", text).strip()
+            # Get the text content, collapsing runs of whitespace
+            body_text = tree.body.text(separator=" ", strip=True) if tree.body else ""
+            text = " ".join(body_text.split())
 
             # Truncate if too long
-            if len(text) > 8000:
-                text = text[:8000] + "... [content truncated]"
+            if len(text) > self.MAX_TEXT_CHARS:
+                text = text[: self.MAX_TEXT_CHARS] + "... [content truncated]"
+
+            await self.cache.set(url, text)
 
             await ctx.info(
                 f"Successfully fetched and parsed content ({len(text)} characters)"
@@ -211,6 +357,8 @@ class WebContentFetcher:
 
 
 class ScholarSearcher:
+    BIBTEX_CONCURRENCY = 4
+
     def __init__(self):
         # Proxy setup is now handled within the search method to ensure thread safety
         pass
@@ -225,18 +373,21 @@ class ScholarSearcher:
 
         if format == "text":
             for i, result in enumerate(results):
-                output.append(f"{i+1}. {result.get('bib', {}).get('title', 'N/A')}")
-                output.append(f"   Authors: {', '.join(result.get('bib', {}).get('author', []))}")
-                output.append(f"   Venue: {result.get('bib', {}).get('venue', 'N/A')}")
-                output.append(f"   Year: {result.get('bib', {}).get('pub_year', 'N/A')}")
-                output.append(f"   URL: {result.get('pub_url', 'N/A')}")
-                output.append(f"Abstract:\n{result.get('bib', {}).get('abstract', 'N/A')}")
-                output.append("")
+                bib = result.get('bib', {})
+                output.append(
+                    f"{i+1}. {bib.get('title', 'N/A')}\n"
+                    f"   Authors: {', '.join(bib.get('author', []))}\n"
+                    f"   Venue: {bib.get('venue', 'N/A')}\n"
+                    f"   Year: {bib.get('pub_year', 'N/A')}\n"
+                    f"   URL: {result.get('pub_url', 'N/A')}\n"
+                    f"Abstract:\n{bib.get('abstract', 'N/A')}\n"
+                )
         else:  # bibtex format
             for i, result in enumerate(results):
-                output.append(f"{i+1}. {result.get('bib', {}).get('title', 'N/A')}")
-                output.append(f"{result.get('bibtex', {})}")
-                output.append("")
+                output.append(
+                    f"{i+1}. {result.get('bib', {}).get('title', 'N/A')}\n"
+                    f"{result.get('bibtex', {})}\n"
+                )
 
         return "\n".join(output)
 
@@ -244,24 +395,37 @@ class ScholarSearcher:
         try:
             await ctx.info(f"Searching Google Scholar for: {query}")
             
-            async def search_with_limit():
-                results = []
+            # scholarly is synchronous, so its calls run in worker threads
+            def collect_pubs():
+                pubs = []
                 try:
                     search_results_iterator = scholarly.search_pubs(query=query, year_low=year_low, year_high=year_high, sort_by=sort_by, start_index=start_index)
-                    for i, pub in enumerate(search_results_iterator):
-                        if len(results) >= max_results:
-                            break
-                        await asyncio.sleep(0.5) # Sleep to avoid rate limiting 
-                        bibtex = scholarly.bibtex(pub)
-                        pub['bibtex'] = bibtex
-                        results.append(pub)
+                    # islice rejects negative limits; treat them as "no results" like before
+                    for pub in itertools.islice(search_results_iterator, max(max_results, 0)):
+                        pubs.append(pub)
                 except Exception as e:
-                    await ctx.error(f"Failed to fetch bib content for query {query}: {str(e)}, the search results may be incomplete")
-                    return results
-                    
-                return results
+                    return pubs, e
+
+                return pubs, None
 
-            results = await search_with_limit()
+            pubs, error = await asyncio.to_thread(collect_pubs)
+            if error is not None:
+                await ctx.error(f"Failed to fetch search results for query {query}: {str(error)}, the search results may be incomplete")
+
+            # Fetch bibtex entries concurrently, a few at a time to stay polite
+            semaphore = asyncio.Semaphore(self.BIBTEX_CONCURRENCY)
+
+            async def fetch_bibtex(pub):
+                async with semaphore:
+                    await asyncio.sleep(0.5) # Sleep to avoid rate limiting
+                    pub['bibtex'] = await asyncio.to_thread(scholarly.bibtex, pub)
+                    return pub
+
+            fetched = await asyncio.gather(*(fetch_bibtex(pub) for pub in pubs), return_exceptions=True)
+            results = [pub for pub in fetched if not isinstance(pub, BaseException)]
+            errors = [e for e in fetched if isinstance(e, BaseException)]
+            if errors:
+                await ctx.error(f"Failed to fetch bib content for query {query}: {str(errors[0])}, the search results may be incomplete")
 
             await ctx.info(f"Successfully found {len(results)} results on Google Scholar")
             return results
@@ -330,7 +494,38 @@ async def scholar_search(query: str, ctx: Context, max_results: int = 10, year_l
         return f"An error occurred while searching Google Scholar: {str(e)}"
 
 
+async def run_sse():
+    """Serve over SSE, closing the shared HTTP client before the event loop stops"""
+    starlette_app = mcp.sse_app()
+    app_lifespan = starlette_app.router.lifespan_context
+
+    @asynccontextmanager
+    async def lifespan(app):
+        async with app_lifespan(app):
+            yield
+            # Pooled connections belong to this loop, so close them on shutdown
+            await _HTTP_CLIENT.aclose()
+
+    starlette_app.router.lifespan_context = lifespan
+
+    config = uvicorn.Config(
+        starlette_app,
+        host=mcp.settings.host,
+        port=mcp.settings.port,
+        log_level=mcp.settings.log_level.lower(),
+    )
+    await uvicorn.Server(config).serve()
+
+
 def main():
+    # uvloop is optional (unavailable on Windows); fall back to the default loop
+    try:
+        import uvloop
+
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
     parser = argparse.ArgumentParser(description="DuckDuckGo MCP Server")
     parser.add_argument(
         "--host",
@@ -348,7 +543,11 @@ def main():
 
     mcp.settings.host = args.host
     mcp.settings.port = args.port
-    mcp.run(transport="sse")
+    try:
+        anyio.run(run_sse)
+    except KeyboardInterrupt:
+        # uvicorn re-raises Ctrl-C once it has shut down cleanly
+        pass
 
 
 if __name__ == "__main__":